@@ -0,0 +1,10 @@
+import os
+
+bind = '0.0.0.0:10000'
+worker_class = 'uvicorn.workers.UvicornWorker'
+timeout = 120
+
+# One worker per available core, capped by the memory budget at roughly
+# 300 MB per worker once it has taken a screenshot: ~65 MB of Python, ~70 MB
+# for Playwright's Node driver and the rest for its Chromium
+workers = max(1, min(len(os.sched_getaffinity(0)), int(os.environ.get('MEM_MB', '512')) // 300))
@@ -1,49 +1,349 @@
 import os
-import io
-import base64
-import json
-import requests
-from flask import Flask, request, jsonify
-from playwright.sync_api import sync_playwright
-import PyPDF2
-from PIL import Image
-
-app = Flask(__name__)
+import gc
+import asyncio
+import hashlib
+import logging
+import threading
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+import httpx
+import orjson
+import uvicorn
+from diskcache import Cache
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from playwright.async_api import async_playwright
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import pypdfium2 as pdfium
 
 # Environment variables
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 POLLINATIONS_API_KEY = os.environ.get('POLLINATIONS_API_KEY')
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'healthy', 'service': 'nanobot-worker'}), 200
+# Upstream endpoints and headers, built once at import
+GEMINI_URL = httpx.URL(
+    'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:streamGenerateContent',
+    params={'alt': 'sse'},
+)
+POLLINATIONS_IMAGE_URL = 'https://image.pollinations.ai/prompt/'
+POLLINATIONS_TTS_URL = 'https://text.pollinations.ai/'
+
+# The API key goes in a header rather than the URL so it stays out of logs
+_GEMINI_HEADERS = {'Content-Type': 'application/json', 'x-goog-api-key': GEMINI_API_KEY or ''}
+# Images and audio are already compressed; ask for them as-is so the bytes
+# can be relayed without a decode step
+_POLLINATIONS_HEADERS = {'Accept-Encoding': 'identity'}
+if POLLINATIONS_API_KEY:
+    _POLLINATIONS_HEADERS['Authorization'] = f'Bearer {POLLINATIONS_API_KEY}'
+
+# Health checks are frequent and never change, so serialise the body once
+_HEALTH_BODY = orjson.dumps({'status': 'healthy', 'service': 'nanobot-worker'})
+
+# Chunk size used when relaying upstream bodies to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Screenshots run one at a time; this many more may wait for the browser
+# before further requests are turned away
+SCREENSHOT_QUEUE_SIZE = 2
+
+# Largest PDF upload accepted by /solve-pdf
+MAX_PDF_BYTES = 25 * 1024 * 1024
+
+# Generated images are a pure function of their parameters, so keep
+# finished ones on disk; shared by every worker process
+image_cache = Cache('/tmp/imgcache', size_limit=200 * 1024 * 1024)
+
+@asynccontextmanager
+async def lifespan(app):
+    # One pooled client for every upstream call so connections are reused
+    # instead of paying a fresh TCP + TLS handshake on every request
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    # Playwright's Node driver and the browser are only started on first use
+    # and then kept alive, so workers that never take a screenshot skip them
+    app.state.playwright = None
+    app.state.browser = None
+    # Cap in-flight work per worker on the expensive endpoints to fit the
+    # memory budget. PDF parsing itself is serialized by _pdfium_lock, so the
+    # PDF slots mainly bound concurrent Gemini calls; the screenshot slot also
+    # guards the lazy browser launch
+    app.state.pdf_sem = asyncio.Semaphore(2)
+    app.state.shot_sem = asyncio.Semaphore(1)
+    app.state.img_sem = asyncio.Semaphore(4)
+    app.state.shot_waiters = 0
+    yield
+    if app.state.browser is not None:
+        await app.state.browser.close()
+    if app.state.playwright is not None:
+        await app.state.playwright.stop()
+    await app.state.http.aclose()
+    image_cache.close()
+
+class PdfSizeLimitMiddleware:
+    """Reject oversized /solve-pdf uploads, with or without a Content-Length."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != '/solve-pdf':
+            return await self.app(scope, receive, send)
+
+        too_large = ORJSONResponse(
+            {'error': f'PDF exceeds {MAX_PDF_BYTES // (1024 * 1024)} MB limit'},
+            status_code=413,
+        )
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None:
+            if not content_length.isdigit():
+                response = ORJSONResponse({'error': 'Invalid Content-Length'}, status_code=400)
+                return await response(scope, receive, send)
+            if int(content_length) > MAX_PDF_BYTES:
+                return await too_large(scope, receive, send)
+
+        # Chunked uploads carry no length up front, so count the body as it
+        # arrives; past the limit, answer 413 ourselves, tell the app the
+        # client has gone, and drop whatever error it sends back
+        received = 0
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {'type': 'http.disconnect'}
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > MAX_PDF_BYTES:
+                    rejected = True
+                    await too_large(scope, receive, send)
+                    return {'type': 'http.disconnect'}
+            return message
+
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(PdfSizeLimitMiddleware)
+
+class ScreenshotRequest(BaseModel):
+    url: str
+    width: int = 1280
+    height: int = 720
+    full_page: bool = False
 
-@app.route('/solve-pdf', methods=['POST'])
-def solve_pdf():
+class ImageRequest(BaseModel):
+    prompt: str
+    width: int = 1024
+    height: int = 1024
+    seed: int = 42
+
+class VoiceoverRequest(BaseModel):
+    text: str
+    voice: str = 'alloy'
+
+class _Slot:
+    """A held semaphore slot that is released at most once."""
+
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self._held = True
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self._semaphore.release()
+
+async def _release(upstream, slot=None):
+    """Close an upstream response and give back the slot it was fetched under."""
+    if upstream is not None:
+        await upstream.aclose()
+    if slot is not None:
+        slot.release()
+
+def _busy_response():
+    return ORJSONResponse({'error': 'Server busy, try again shortly'}, status_code=503)
+
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request, exc):
+    return ORJSONResponse({'error': '; '.join(map(_describe_error, exc.errors()))}, status_code=400)
+
+def _describe_error(error):
+    # Multipart parsing turns a file part without a filename into a plain
+    # string, so an empty filename surfaces here rather than in the handler
+    if error['type'] == 'value_error' and tuple(error['loc']) == ('body', 'file'):
+        return 'Empty filename'
+    # Drop the leading 'body'/'query' segment unless it is all there is
+    loc = error['loc'][1:] or error['loc'][:1]
+    return f"{'.'.join(str(part) for part in loc)}: {error['msg']}"
+
+@app.exception_handler(Exception)
+async def error_handler(request, exc):
+    return ORJSONResponse({'error': str(exc)}, status_code=500)
+
+def _image_cache_key(prompt, width, height, seed):
+    raw = f'{width}x{height}|{seed}|{prompt}'.encode()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+async def _tee_to_cache(chunks, key, content_type):
+    """Pass chunks through, caching the body once it has been fully sent."""
+    parts = []
+    async for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    # Store raw bytes (tagged with their type) so diskcache writes them
+    # as-is instead of pickling a copy
+    await run_in_threadpool(image_cache.set, key, b''.join(parts), tag=content_type)
+
+async def _relay(chunks, upstream, slot=None):
+    """Yield a response body, then close its upstream and release its slot,
+    even if reading it fails."""
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await _release(upstream, slot)
+
+def _stream_response(chunks, upstream, media_type, slot=None):
+    # The background task still covers a body that was never iterated
+    return StreamingResponse(
+        _relay(chunks, upstream, slot),
+        media_type=media_type,
+        background=BackgroundTask(_release, upstream, slot),
+    )
+
+def _proxy_stream(upstream, default_content_type, cache_key=None, slot=None):
+    """Relay an upstream response body to the client chunk by chunk."""
+    content_type = upstream.headers.get('Content-Type', default_content_type)
+    body = upstream.aiter_bytes(STREAM_CHUNK_SIZE)
+    if cache_key is not None:
+        body = _tee_to_cache(body, cache_key, content_type)
+    return _stream_response(body, upstream, content_type, slot)
+
+async def _take_screenshot(url, width, height, full_page):
+    app.state.shot_waiters += 1
+    try:
+        await app.state.shot_sem.acquire()
+    finally:
+        app.state.shot_waiters -= 1
+    try:
+        if app.state.playwright is None:
+            app.state.playwright = await async_playwright().start()
+        browser = app.state.browser
+        if browser is None or not browser.is_connected():
+            # Docker's default /dev/shm is only 64 MB, which a long-lived
+            # Chromium taking full-page screenshots can exhaust
+            browser = app.state.browser = await app.state.playwright.chromium.launch(
+                args=['--disable-dev-shm-usage'],
+            )
+        context = await browser.new_context(viewport={'width': width, 'height': height})
+        try:
+            page = await context.new_page()
+            await page.goto(url, wait_until='networkidle', timeout=30000)
+            return await page.screenshot(full_page=full_page)
+        finally:
+            await context.close()
+    finally:
+        app.state.shot_sem.release()
+
+# PDFium is not thread-safe; concurrent use from two threads can crash
+# the process, so every document is parsed under this lock
+_pdfium_lock = threading.Lock()
+
+def _extract_pdf_text(stream):
+    """Extract the text of every page, releasing each page as we go."""
+    with _pdfium_lock:
+        pdf = pdfium.PdfDocument(stream)
+        try:
+            pages = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_bounded())
+                textpage.close()
+                page.close()
+            return '\n'.join(pages)
+        finally:
+            pdf.close()
+
+async def _gemini_text_deltas(upstream):
+    """Yield the text of each chunk of a Gemini SSE stream as it arrives."""
+    async for line in upstream.aiter_lines():
+        if not line.startswith('data: '):
+            continue
+        chunk = orjson.loads(line[6:])
+        for candidate in chunk.get('candidates', [])[:1]:
+            for part in candidate.get('content', {}).get('parts', []):
+                if 'text' in part:
+                    yield part['text']
+
+def _accept_quality(accept, media_type):
+    """Quality the Accept header gives media_type, from its most specific match."""
+    wildcard = media_type.split('/')[0] + '/*'
+    specificity, quality = -1, 0.0
+    for item in accept.lower().split(','):
+        accepted, *params = (p.strip() for p in item.split(';'))
+        rank = {media_type: 2, wildcard: 1, '*/*': 0}.get(accepted)
+        if rank is None or rank <= specificity:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        specificity, quality = rank, q
+    return quality
+
+def _wants_event_stream(request):
+    """Whether the client prefers text/event-stream over JSON; ties go to JSON."""
+    accept = request.headers.get('Accept', '')
+    return _accept_quality(accept, 'text/event-stream') > _accept_quality(accept, 'application/json')
+
+@app.get('/health')
+async def health_check():
+    return Response(_HEALTH_BODY, media_type='application/json')
+
+@app.post('/solve-pdf')
+async def solve_pdf(request: Request, file: UploadFile = File(...)):
     if not GEMINI_API_KEY:
-        return jsonify({'error': 'GEMINI_API_KEY not configured'}), 500
-    
+        return ORJSONResponse({'error': 'GEMINI_API_KEY not configured'}, status_code=500)
+
+    # Reject non-PDFs from their first bytes, not the client's content type
+    if await file.read(5) != b'%PDF-':
+        await file.close()
+        return ORJSONResponse({'error': 'Not a PDF'}, status_code=400)
+    await file.seek(0)
+
+    if app.state.pdf_sem.locked():
+        await file.close()
+        return _busy_response()
+
+    # The slot is held until the Gemini response has been fully read or
+    # relayed, not just until its headers arrive
+    await app.state.pdf_sem.acquire()
+    slot = _Slot(app.state.pdf_sem)
+    response = None
+    streaming = False
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No PDF file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'Empty filename'}), 400
-        
-        # Read PDF in memory-efficient way
-        pdf_stream = io.BytesIO(file.read())
-        reader = PyPDF2.PdfReader(pdf_stream)
-        
-        text = ''
-        for page in reader.pages:
-            text += page.extract_text() + '\n'
-        
-        pdf_stream.close()
-        
+        # Parse straight from the spooled upload file rather than copying the
+        # whole file into memory first, off the event loop
+        try:
+            text = await run_in_threadpool(_extract_pdf_text, file.file)
+        finally:
+            await file.close()
+
         # Call Gemini API
-        gemini_url = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}'
-        
         payload = {
             'contents': [{
                 'parts': [{
@@ -51,126 +351,120 @@ def solve_pdf():
                 }]
             }]
         }
-        
-        response = requests.post(gemini_url, json=payload, timeout=60)
-        result = response.json()
-        
-        if 'candidates' in result and len(result['candidates']) > 0:
-            solution = result['candidates'][0]['content']['parts'][0]['text']
-            return jsonify({'solution': solution, 'status': 'success'}), 200
-        else:
-            return jsonify({'error': 'Failed to get solution from Gemini'}), 500
-            
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/screenshot', methods=['POST'])
-def capture_screenshot():
-    try:
-        data = request.get_json()
-        if not data or 'url' not in data:
-            return jsonify({'error': 'URL not provided'}), 400
-        
-        url = data['url']
-        width = data.get('width', 1280)
-        height = data.get('height', 720)
-        full_page = data.get('full_page', False)
-        
-        with sync_playwright() as p:
-            browser = p.chromium.launch()
-            page = browser.new_page(viewport={'width': width, 'height': height})
-            page.goto(url, wait_until='networkidle', timeout=30000)
-            
-            if full_page:
-                screenshot = page.screenshot(full_page=True)
-            else:
-                screenshot = page.screenshot()
-            
-            browser.close()
-        
-        # Convert to base64
-        img_base64 = base64.b64encode(screenshot).decode('utf-8')
-        
-        return jsonify({
-            'screenshot': img_base64,
-            'format': 'png',
-            'status': 'success'
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/generate-image', methods=['POST'])
-def generate_image():
+
+        client = app.state.http
+        response = await client.send(
+            client.build_request('POST', GEMINI_URL, content=orjson.dumps(payload), headers=_GEMINI_HEADERS),
+            stream=True,
+        )
+
+        if response.status_code != 200:
+            return ORJSONResponse({'error': 'Failed to get solution from Gemini'}, status_code=500)
+
+        # Relay the solution as it is generated if the client asked for SSE
+        if _wants_event_stream(request):
+            async def events():
+                async for delta in _gemini_text_deltas(response):
+                    yield b'data: ' + orjson.dumps({'text': delta}) + b'\n\n'
+
+            streaming = True
+            return _stream_response(events(), response, 'text/event-stream', slot)
+
+        solution = ''.join([delta async for delta in _gemini_text_deltas(response)])
+    finally:
+        if not streaming:
+            await _release(response, slot)
+
+    if solution:
+        return {'solution': solution, 'status': 'success'}
+    else:
+        return ORJSONResponse({'error': 'Failed to get solution from Gemini'}, status_code=500)
+
+@app.post('/screenshot')
+async def capture_screenshot(body: ScreenshotRequest):
+    if app.state.shot_sem.locked() and app.state.shot_waiters >= SCREENSHOT_QUEUE_SIZE:
+        return _busy_response()
+
+    screenshot = await _take_screenshot(body.url, body.width, body.height, body.full_page)
+
+    return Response(
+        screenshot,
+        media_type='image/png',
+        headers={'Content-Disposition': 'attachment; filename=screenshot.png'},
+    )
+
+@app.post('/generate-image')
+async def generate_image(body: ImageRequest):
     if not POLLINATIONS_API_KEY:
-        return jsonify({'error': 'POLLINATIONS_API_KEY not configured'}), 500
-    
+        return ORJSONResponse({'error': 'POLLINATIONS_API_KEY not configured'}, status_code=500)
+
+    cache_key = _image_cache_key(body.prompt, body.width, body.height, body.seed)
+    image, content_type = await run_in_threadpool(image_cache.get, cache_key, tag=True)
+    if image is not None:
+        return Response(image, media_type=content_type)
+
+    # Call Pollinations AI API
+    pollinations_url = POLLINATIONS_IMAGE_URL + quote(body.prompt, safe='')
+    params = {'width': body.width, 'height': body.height, 'seed': body.seed, 'nologo': 'true'}
+
+    if app.state.img_sem.locked():
+        return _busy_response()
+
+    # The slot is held until the image has been relayed and cached
+    await app.state.img_sem.acquire()
+    slot = _Slot(app.state.img_sem)
+    client = app.state.http
     try:
-        data = request.get_json()
-        if not data or 'prompt' not in data:
-            return jsonify({'error': 'Prompt not provided'}), 400
-        
-        prompt = data['prompt']
-        width = data.get('width', 1024)
-        height = data.get('height', 1024)
-        seed = data.get('seed', 42)
-        
-        # Call Pollinations AI API
-        pollinations_url = f'https://image.pollinations.ai/prompt/{requests.utils.quote(prompt)}?width={width}&height={height}&seed={seed}&nologo=true'
-        
-        headers = {}
-        if POLLINATIONS_API_KEY:
-            headers['Authorization'] = f'Bearer {POLLINATIONS_API_KEY}'
-        
-        response = requests.get(pollinations_url, headers=headers, timeout=60)
-        
-        if response.status_code == 200:
-            img_base64 = base64.b64encode(response.content).decode('utf-8')
-            return jsonify({
-                'image': img_base64,
-                'format': 'png',
-                'status': 'success'
-            }), 200
-        else:
-            return jsonify({'error': f'Image generation failed: {response.status_code}'}), 500
-            
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/voiceover', methods=['POST'])
-def generate_voiceover():
+        response = await client.send(
+            client.build_request('GET', pollinations_url, params=params, headers=_POLLINATIONS_HEADERS),
+            stream=True,
+        )
+    except BaseException:
+        slot.release()
+        raise
+
+    if response.status_code == 200:
+        return _proxy_stream(response, 'image/png', cache_key, slot)
+    else:
+        await _release(response, slot)
+        return ORJSONResponse({'error': f'Image generation failed: {response.status_code}'}, status_code=500)
+
+@app.post('/voiceover')
+async def generate_voiceover(body: VoiceoverRequest):
     if not POLLINATIONS_API_KEY:
-        return jsonify({'error': 'POLLINATIONS_API_KEY not configured'}), 500
-    
+        return ORJSONResponse({'error': 'POLLINATIONS_API_KEY not configured'}, status_code=500)
+
+    # Call Pollinations TTS API
+    pollinations_url = POLLINATIONS_TTS_URL + quote(body.text, safe='')
+    params = {'voice': body.voice}
+
+    client = app.state.http
+    response = await client.send(
+        client.build_request('GET', pollinations_url, params=params, headers=_POLLINATIONS_HEADERS),
+        stream=True,
+    )
+
+    if response.status_code == 200:
+        return _proxy_stream(response, 'audio/mpeg')
+    else:
+        await response.aclose()
+        return ORJSONResponse({'error': f'Voice generation failed: {response.status_code}'}, status_code=500)
+
+# Optional generational GC tuning, e.g. GC_THRESHOLD=700,10,10; a bad value
+# is logged and ignored rather than stopping every worker from booting
+GC_THRESHOLD = os.environ.get('GC_THRESHOLD')
+if GC_THRESHOLD:
     try:
-        data = request.get_json()
-        if not data or 'text' not in data:
-            return jsonify({'error': 'Text not provided'}), 400
-        
-        text = data['text']
-        voice = data.get('voice', 'alloy')
-        
-        # Call Pollinations TTS API
-        pollinations_url = f'https://text.pollinations.ai/{requests.utils.quote(text)}?voice={voice}'
-        
-        headers = {}
-        if POLLINATIONS_API_KEY:
-            headers['Authorization'] = f'Bearer {POLLINATIONS_API_KEY}'
-        
-        response = requests.get(pollinations_url, headers=headers, timeout=60)
-        
-        if response.status_code == 200:
-            audio_base64 = base64.b64encode(response.content).decode('utf-8')
-            return jsonify({
-                'audio': audio_base64,
-                'format': 'mp3',
-                'status': 'success'
-            }), 200
-        else:
-            return jsonify({'error': f'Voice generation failed: {response.status_code}'}), 500
-            
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        gc.set_threshold(*(int(v) for v in GC_THRESHOLD.split(',')))
+    except (TypeError, ValueError):
+        logging.getLogger('uvicorn.error').warning(
+            'Ignoring malformed GC_THRESHOLD=%r; expected up to three comma-separated integers',
+            GC_THRESHOLD,
+        )
+
+# Everything allocated during import lives for the whole process; move it
+# into the permanent generation so full collections stop rescanning it
+gc.freeze()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=10000)
+    uvicorn.run(app, host='0.0.0.0', port=10000, loop='uvloop', http='httptools')